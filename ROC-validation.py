@@ -5,6 +5,9 @@ import random
 import math
 import os
 import csv
+import multiprocessing
+import hashlib
+import zlib
 import matplotlib.pyplot as plt
 
 # Setting a random seed at the start of a program can
@@ -14,15 +17,21 @@ random.seed(10000)
 
 def parse_arguments():
     # Here is where the input arguments are parsed.
-    # There are two arguments: -e, which is the 
+    # There are two main arguments: -e, which is the 
     # folder in which program is being run, and -f,
     # which corresponds to the --fdrlimit argument to
     # Wellington (and is set arbitrarily, often to -5,
-    # for pipelines invoking HINT).
+    # for pipelines invoking HINT). -s seeds the NumPy
+    # RandomState used for the false events' values.
     
     parser = argparse.ArgumentParser(description='Produces a ROC plot from ChIP-seq validation data.')
     parser.add_argument('-e','--experiment',type=str,help='the output directory')
     parser.add_argument('-f','--fdrlimit',type=int,help='the log10 p-value cutoff')
+    parser.add_argument('-s','--seed',type=int,default=10000,help='the random seed')
+    parser.add_argument('-c','--cache',type=str,help='a directory caching parsed scores and curves between runs (implies the per-target mode)')
+    parser.add_argument('-b','--bootstrap',type=int,help='report AUC confidence intervals from this many bootstrap replicates')
+    parser.add_argument('-a','--alpha',type=float,default=0.05,help='one minus the confidence level of the bootstrap intervals')
+    parser.add_argument('-p','--processes',type=int,help='evaluate ChIP targets in this many worker processes')
     
     return parser.parse_args()
 
@@ -90,6 +99,32 @@ def generate_lognormal(limit):
     return math.pow(10.0,-lognorm_value)
 
 
+def generate_lognormals(count, limit, rng):
+
+    # This draws count values the same way as
+    # generate_lognormal, but all at once. A lognormal
+    # value v is kept when 10^-v >= 10^limit, that is
+    # when v <= -limit, which only happens for a
+    # negative limit.
+    if limit >= 0:
+        raise ValueError('the log10 p-value cutoff must be negative')
+    cutoff = -float(limit)
+
+    # This is the fraction of draws that are kept, so
+    # each round asks for about as many as are missing.
+    accept = 0.5*(1.0+math.erf(math.log(cutoff)/math.sqrt(2.0)))
+
+    lognorm_values = np.empty(count)
+    filled = 0
+    while filled < count:
+        draws = rng.lognormal(size=int((count-filled)/accept*1.1)+16)
+        draws = draws[draws <= cutoff][:count-filled]
+        lognorm_values[filled:filled+len(draws)] = draws
+        filled += len(draws)
+
+    return np.power(10.0,-lognorm_values)
+
+
 def produce_pred_values(directory, limit):
 
     # You don't care about the events as much as
@@ -130,6 +165,84 @@ def produce_pred_values(directory, limit):
     return tp_values,fp_values,fn_values,tn_values
 
 
+def count_lines(file):
+
+    # This counts lines like find_file_length, but
+    # reads the file in large binary blocks and counts
+    # newlines instead of building a list of lines.
+    count = 0
+    last = b'\n'
+    bedfile = open(file,'rb')
+    block = bedfile.read(1<<22)
+    while block:
+        count += block.count(b'\n')
+        last = block[-1:]
+        block = bedfile.read(1<<22)
+    bedfile.close()
+
+    # A last line without a newline still counts.
+    if last != b'\n':
+        count += 1
+
+    return count
+
+
+def read_score_column(file):
+
+    # Column 15 holds the footprint's log10 p-value, and
+    # it is the only one we need, so it is read straight
+    # into a float array in a single pass. An empty file
+    # is caught from its size, without reading it.
+    if os.path.getsize(file) == 0:
+        return np.zeros(0)
+
+    return np.loadtxt(file,delimiter='\t',usecols=(14,),ndmin=1,dtype=float)
+
+
+def read_event_scores(directory):
+
+    # Each file is read once: column 15 of the true and
+    # false positives, and only the line counts of the
+    # false and true negatives.
+    tp_scores = read_score_column(directory+'/true_positives.bed')
+    fp_scores = read_score_column(directory+'/false_positives.bed')
+    fn_len = count_lines(directory+'/false_negatives.bed')
+    tn_len = count_lines(directory+'/true_negatives.bed')
+
+    return tp_scores,fp_scores,fn_len,tn_len
+
+
+def scores_to_pred_values(scores, limit, rng):
+
+    # High scores go to low p-values, and the falses,
+    # lacking a value, are given random values.
+    tp_scores,fp_scores,fn_len,tn_len = scores
+    tp_values = 1.0 - np.power(10.0,-np.abs(tp_scores))
+    fp_values = 1.0 - np.power(10.0,-np.abs(fp_scores))
+    fn_values = generate_lognormals(fn_len,limit,rng)
+    tn_values = generate_lognormals(tn_len,limit,rng)
+
+    return tp_values,fp_values,fn_values,tn_values
+
+
+def fast_pred_values(directory, limit, rng):
+
+    # The same values as produce_pred_values, with each
+    # file read once and the scores computed as arrays.
+    return scores_to_pred_values(read_event_scores(directory), limit, rng)
+
+
+def fast_predlabel_vectors(tpv,fpv,fnv,tnv):
+
+    # The same vectors as craft_predlabel_vectors, built
+    # by concatenation: positives are TPs and FNs.
+    predictions = np.concatenate([tpv,fpv,fnv,tnv])
+    labels = np.concatenate([np.ones(len(tpv)),np.zeros(len(fpv)),
+                             np.ones(len(fnv)),np.zeros(len(tnv))])
+
+    return predictions, labels
+
+
 def craft_predlabel_vectors(tpv,fpv,fnv,tnv):
 
     # Initializing numpy arrays for all events.
@@ -155,8 +268,12 @@ def craft_predlabel_vectors(tpv,fpv,fnv,tnv):
     return predictions, labels
 
 
-def iterate_through_chip(experiment, limit):
+def iterate_through_chip(experiment, limit, seed=10000):
     
+    # The false events' values come from one seeded
+    # RandomState, so runs can be reproduced.
+    rng = np.random.RandomState(seed)
+
     # Initializing fpr vector.
     mean_tpr = []
     mean_fpr = np.linspace(0,1,100)
@@ -166,14 +283,14 @@ def iterate_through_chip(experiment, limit):
     # the event bedfiles.
     for chip_target in os.listdir(experiment+'/ChIP-validation'):
         # Produces the lists/lengths for ROC analysis.
-        tpv,fpv,fnv,tnv = produce_pred_values(experiment
+        tpv,fpv,fnv,tnv = fast_pred_values(experiment
                                               +'/ChIP-validation/'
-                                              +chip_target, limit)
+                                              +chip_target, limit, rng)
         # Checks to make sure the lists aren't all
         # true negatives.
         if len(tpv)+len(fpv)+len(fnv) > 0:
             # Produces the vectors from the event lists.
-            preds, labels = craft_predlabel_vectors(tpv,fpv,fnv,tnv)
+            preds, labels = fast_predlabel_vectors(tpv,fpv,fnv,tnv)
             # Performs the ROC analysis.
             fpr,tpr,thresholds = skm.roc_curve(labels,preds)
             new_mean = np.interp(mean_fpr,fpr,tpr).tolist()
@@ -193,6 +310,248 @@ def iterate_through_chip(experiment, limit):
     print "Mean AUC:",mean_auc
 
 
+def file_fingerprint(directory):
+
+    # The four event files are identified by their size
+    # and modification time; if none of them changed,
+    # neither did the scores read from them.
+    parts = []
+    for name in ['true_positives','false_positives','false_negatives','true_negatives']:
+        stat = os.stat(directory+'/'+name+'.bed')
+        parts.append(name+':'+str(stat.st_size)+':'+repr(stat.st_mtime))
+
+    return hashlib.sha1('|'.join(parts).encode('ascii')).hexdigest()
+
+
+def save_cache(path, **arrays):
+
+    # A cache file is written under a temporary name and
+    # renamed into place, so an interrupted run never
+    # leaves a truncated .npz behind. np.savez adds .npz
+    # to names that lack it, hence the temporary suffix.
+    temp = path[:-len('.npz')]+'.'+str(os.getpid())+'.tmp.npz'
+    np.savez(temp, **arrays)
+    os.rename(temp, path)
+
+
+def cached_event_scores(directory, cache, fingerprint):
+
+    # Parsed scores only depend on the files, so they are
+    # reused across changes to the cutoff or seed.
+    path = cache+'/'+os.path.basename(directory)+'-scores-'+fingerprint+'.npz'
+    if os.path.exists(path):
+        stored = np.load(path)
+        return stored['tp'],stored['fp'],int(stored['fn_len']),int(stored['tn_len'])
+
+    tp_scores,fp_scores,fn_len,tn_len = read_event_scores(directory)
+    save_cache(path,tp=tp_scores,fp=fp_scores,fn_len=fn_len,tn_len=tn_len)
+
+    return tp_scores,fp_scores,fn_len,tn_len
+
+
+def evaluate_target(task):
+
+    # This runs the ROC analysis for a single ChIP
+    # target, with its own RandomState, in a worker
+    # process. Targets that are all true negatives
+    # give None. With a cache directory, the curve is
+    # stored under the files' fingerprint, the cutoff
+    # and the seed, and reloaded when they all match.
+    directory, limit, seed, cache = task
+    if cache is None:
+        scores = read_event_scores(directory)
+    else:
+        fingerprint = file_fingerprint(directory)
+        key = hashlib.sha1((fingerprint+':'+str(limit)+':'+str(seed)).encode('ascii')).hexdigest()
+        path = cache+'/'+os.path.basename(directory)+'-curve-'+key+'.npz'
+        if os.path.exists(path):
+            stored = np.load(path)
+            if len(stored['fpr']) == 0:
+                return None
+            return stored['fpr'], stored['tpr'], stored['auc'][()]
+        scores = cached_event_scores(directory, cache, fingerprint)
+
+    tp_scores,fp_scores,fn_len,tn_len = scores
+    if len(tp_scores)+len(fp_scores)+fn_len == 0:
+        result = None
+    else:
+        rng = np.random.RandomState(seed)
+        tpv,fpv,fnv,tnv = scores_to_pred_values(scores, limit, rng)
+        preds, labels = fast_predlabel_vectors(tpv,fpv,fnv,tnv)
+        fpr,tpr,thresholds = skm.roc_curve(labels,preds)
+        result = (fpr, tpr, skm.auc(fpr, tpr))
+
+    if cache is not None:
+        if result is None:
+            save_cache(path,fpr=np.zeros(0),tpr=np.zeros(0),auc=0.0)
+        else:
+            save_cache(path,fpr=result[0],tpr=result[1],auc=result[2])
+
+    return result
+
+
+def mean_roc(curves):
+
+    # The mean curve over a fixed fpr grid, pinned to
+    # (0,0) and (1,1) like iterate_through_chip's.
+    mean_fpr = np.linspace(0,1,100)
+    tprs = np.array([np.interp(mean_fpr,fpr,tpr) for fpr,tpr,roc_auc in curves])
+    mean_tpr = tprs.mean(axis=0)
+    mean_tpr[0] = 0.0
+    mean_tpr[-1] = 1.0
+
+    return mean_fpr, mean_tpr, skm.auc(mean_fpr,mean_tpr)
+
+
+def target_seed(seed, chip_target):
+
+    # Each target's seed is an integer made from the
+    # master seed and the target's name, so it is the
+    # same whatever the number of workers or the other
+    # targets present.
+    return (seed*1000003 + (zlib.crc32(chip_target.encode('utf-8')) & 0xffffffff)) % 2**32
+
+
+def parallel_through_chip(experiment, limit, seed=10000, processes=None, cache=None):
+
+    chip_targets = sorted(os.listdir(experiment+'/ChIP-validation'))
+    if cache is not None and not os.path.isdir(cache):
+        os.makedirs(cache)
+    tasks = [(experiment+'/ChIP-validation/'+chip_target, limit, target_seed(seed,chip_target), cache)
+             for chip_target in chip_targets]
+
+    if processes == 1:
+        results = [evaluate_target(task) for task in tasks]
+    else:
+        pool = multiprocessing.Pool(processes)
+        results = pool.map(evaluate_target, tasks)
+        pool.close()
+        pool.join()
+
+    curves = {}
+    for chip_target,result in zip(chip_targets,results):
+        if result is not None:
+            curves[chip_target] = result
+            print chip_target,"AUC:",result[2]
+
+    if curves:
+        mean_fpr,mean_tpr,mean_auc = mean_roc([curves[chip_target] for chip_target in sorted(curves)])
+        print "Mean AUC:",mean_auc
+
+    return curves
+
+
+def rank_groups(preds, labels):
+
+    # Events are sorted by score once, highest first, and
+    # events with equal scores share a group. What is
+    # returned is the group of every positive and of
+    # every negative, and the number of groups.
+    order = np.argsort(-preds, kind='mergesort')
+    sorted_preds = preds[order]
+    groups = np.cumsum(np.concatenate([[True],sorted_preds[1:] != sorted_preds[:-1]])) - 1
+    group_of = np.empty(len(preds), dtype=np.int64)
+    group_of[order] = groups
+
+    return group_of[labels == 1], group_of[labels == 0], int(groups[-1]) + 1
+
+
+def bootstrap_curves(preds, labels, replicates, rng, mean_fpr):
+
+    # Positives and negatives are resampled separately,
+    # with replacement. A replicate only needs how many
+    # of each land in every score group, which bincount
+    # gives for a whole batch of replicates at once.
+    # From those counts, the AUC is the chance that a
+    # positive outscores a negative (ties count half),
+    # and cumulative sums give the ROC curve, which is
+    # interpolated onto mean_fpr.
+    pos_groups, neg_groups, n_groups = rank_groups(preds, labels)
+    n_pos = len(pos_groups); n_neg = len(neg_groups)
+    batch = max(1, (1<<24) // max(n_pos+n_neg, 1))
+
+    aucs = np.empty(replicates)
+    tprs = np.empty((replicates, len(mean_fpr)))
+    for start in range(0, replicates, batch):
+        size = min(batch, replicates-start)
+        offsets = (np.arange(size)*n_groups)[:,None]
+        pos_counts = np.bincount((pos_groups[rng.randint(n_pos, size=(size,n_pos))]+offsets).ravel(),
+                                 minlength=size*n_groups).reshape(size,n_groups)
+        neg_counts = np.bincount((neg_groups[rng.randint(n_neg, size=(size,n_neg))]+offsets).ravel(),
+                                 minlength=size*n_groups).reshape(size,n_groups)
+        cum_pos = np.cumsum(pos_counts, axis=1)
+        cum_neg = np.cumsum(neg_counts, axis=1)
+        aucs[start:start+size] = (pos_counts*(n_neg-cum_neg+0.5*neg_counts)).sum(axis=1)/float(n_pos*n_neg)
+        for row in range(size):
+            fpr = np.concatenate([[0.0], cum_neg[row]/float(n_neg)])
+            tpr = np.concatenate([[0.0], cum_pos[row]/float(n_pos)])
+            tprs[start+row] = np.interp(mean_fpr, fpr, tpr)
+
+    return aucs, tprs
+
+
+def bootstrap_target(task):
+
+    # The same analysis as evaluate_target, with the
+    # same values for the false events, plus bootstrap
+    # replicates drawn from a second RandomState seeded
+    # with the target's seed plus one. Targets without
+    # both positives and negatives give None.
+    directory, limit, seed, cache, replicates = task
+    if cache is None:
+        scores = read_event_scores(directory)
+    else:
+        scores = cached_event_scores(directory, cache, file_fingerprint(directory))
+    tpv,fpv,fnv,tnv = scores_to_pred_values(scores, limit, np.random.RandomState(seed))
+    if len(tpv)+len(fnv) == 0 or len(fpv)+len(tnv) == 0:
+        return None
+    preds, labels = fast_predlabel_vectors(tpv,fpv,fnv,tnv)
+    fpr,tpr,thresholds = skm.roc_curve(labels,preds)
+    mean_fpr = np.linspace(0,1,100)
+    aucs, tprs = bootstrap_curves(preds, labels, replicates,
+                                  np.random.RandomState((seed+1) % 2**32), mean_fpr)
+
+    return skm.auc(fpr, tpr), aucs, tprs
+
+
+def bootstrap_through_chip(experiment, limit, replicates, seed=10000, processes=None, cache=None, alpha=0.05):
+
+    # Each target's AUC is printed with a (1-alpha)
+    # percentile interval. Replicate b of the mean curve
+    # averages replicate b of every target's curve.
+    chip_targets = sorted(os.listdir(experiment+'/ChIP-validation'))
+    if cache is not None and not os.path.isdir(cache):
+        os.makedirs(cache)
+    tasks = [(experiment+'/ChIP-validation/'+chip_target, limit, target_seed(seed,chip_target), cache, replicates)
+             for chip_target in chip_targets]
+
+    if processes == 1:
+        results = [bootstrap_target(task) for task in tasks]
+    else:
+        pool = multiprocessing.Pool(processes)
+        results = pool.map(bootstrap_target, tasks)
+        pool.close()
+        pool.join()
+
+    bounds = [100*alpha/2, 100*(1-alpha/2)]
+    all_tprs = []
+    for chip_target,result in zip(chip_targets,results):
+        if result is not None:
+            roc_auc, aucs, tprs = result
+            low, high = np.percentile(aucs, bounds)
+            print chip_target,"AUC:",roc_auc,"CI:",low,high
+            all_tprs.append(tprs)
+
+    if all_tprs:
+        mean_fpr = np.linspace(0,1,100)
+        mean_tprs = np.mean(all_tprs, axis=0)
+        mean_tprs[:,0] = 0.0
+        mean_tprs[:,-1] = 1.0
+        mean_aucs = ((mean_tprs[:,1:]+mean_tprs[:,:-1])/2*np.diff(mean_fpr)).sum(axis=1)
+        low, high = np.percentile(mean_aucs, bounds)
+        print "Mean AUC CI:",low,high
+
+
 def __main__():
 
     # This function governs all other functions and runs
@@ -206,7 +565,12 @@ def __main__():
     limit = args.fdrlimit
 
     # Here we read the input and produce figures.
-    iterate_through_chip(experiment,limit)
+    if args.bootstrap:
+        bootstrap_through_chip(experiment,limit,args.bootstrap,args.seed,args.processes,args.cache,args.alpha)
+    elif args.processes or args.cache:
+        parallel_through_chip(experiment,limit,args.seed,args.processes,args.cache)
+    else:
+        iterate_through_chip(experiment,limit,args.seed)
 
 
 # The condition that the program is run directly.
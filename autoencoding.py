@@ -5,76 +5,182 @@
 
 import numpy as np
 import json
-
-def read_in_data():
-	input = np.load('input.npy')
-	return input
-
-
-input = read_in_data()
-print input.shape
+import argparse
+import resource
+import sys
+import time
+import batch_loader as bl
 
 import tensorflow as tf
-from keras.layers import Input,Dense,Lambda
+from keras.layers import Input,Dense,Lambda,Reshape,Flatten
+from keras.layers import Conv1D,MaxPooling1D
 from keras.models import Model
 from keras import optimizers
 from keras import backend as K
 from keras import metrics
-sgd = optimizers.SGD(lr=0.1)
 
-encoding_dim = 200
 
-input_img = Input(shape=(10000,))
-encoded = Dense(encoding_dim,activation='sigmoid')(input_img)
-decoded = Dense(10000,activation='relu')(encoded)
+def parse_arguments():
 
-autoencoder = Model(input_img,decoded)
-encoder = Model(input_img,encoded)
+	parser = argparse.ArgumentParser(description='train or benchmark the Karpas-422 models')
+	parser.add_argument('-i','--input',type=str,default='input.npy',help='the input matrix (.npy, .npz or .bits.npy)')
+	parser.add_argument('-b','--benchmark',type=str,help='benchmark a model (dense or conv) instead of training')
+	parser.add_argument('-s','--steps',type=int,default=50,help='timed steps per benchmark')
+	parser.add_argument('-w','--warmup',type=int,default=5,help='untimed steps before the benchmark')
+	parser.add_argument('-n','--batch-size',type=int,default=1000,help='batch size')
+	parser.add_argument('-p','--prefetch',type=int,default=4,help='batches prefetched by the loader')
+	parser.add_argument('--real',action='store_true',help='benchmark on --input through batch_loader instead of synthetic data')
 
-encoded_input = Input(shape=(encoding_dim,))
-decoder_layer = autoencoder.layers[-1]
-decoder = Model(encoded_input,decoder_layer(encoded_input))
+	return parser.parse_args()
 
-autoencoder.compile(optimizer=sgd,loss='binary_crossentropy',metrics=['mae','acc'])
 
-np.random.shuffle(input)
-input_train = input[:190000]
-input_test = input[190000:192000]
+def read_in_data(path='input.npy'):
+	input = bl.open_input(path)
+	return input
 
-history = autoencoder.fit(input_train,input_train,
-	epochs=20,batch_size=1000,shuffle=True,
-	validation_data=(input_test,input_test))
 
+def build_autoencoder(input_dim=10000,encoding_dim=200):
 
-encoded_imgs = encoder.predict(input_test)
-decoded_imgs = decoder.predict(encoded_imgs)
-print input_test[2].tolist()
-print encoded_imgs[2].tolist()
-print decoded_imgs[2].tolist()
+	sgd = optimizers.SGD(lr=0.1)
+	input_img = Input(shape=(input_dim,))
+	encoded = Dense(encoding_dim,activation='sigmoid')(input_img)
+	decoded = Dense(input_dim,activation='relu')(encoded)
 
+	autoencoder = Model(input_img,decoded)
+	encoder = Model(input_img,encoded)
 
-from keras.layers import Conv1D,MaxPooling1D
+	encoded_input = Input(shape=(encoding_dim,))
+	decoder_layer = autoencoder.layers[-1]
+	decoder = Model(encoded_input,decoder_layer(encoded_input))
+
+	autoencoder.compile(optimizer=sgd,loss='binary_crossentropy',metrics=['mae','acc'])
+	return autoencoder,encoder,decoder
+
+
+def build_conv_model(input_dim=10000):
+
+	# Conv1D needs a channel axis, and the second pooling is wider than
+	# what reaches it, hence the Reshape and the 'same' padding.
+	sgd = optimizers.SGD(lr=0.1)
+	input_img = Input(shape=(input_dim,))
+	channels = Reshape((input_dim,1))(input_img)
+	conv1 = Conv1D(5,10,strides=5,activation=None)(channels)
+	pooling1 = MaxPooling1D(pool_size=5)(conv1)
+	conv2 = Conv1D(20,25,strides=20,activation=None)(pooling1)
+	pooling2 = MaxPooling1D(pool_size=20,padding='same')(conv2)
+	flat = Flatten()(pooling2)
+	dense1 = Dense(100,activation='sigmoid')(flat)
+	dense2 = Dense(100,activation='sigmoid')(dense1)
+	dense3 = Dense(1,activation='sigmoid')(dense2)
+
+	model = Model(input_img,dense3)
+	model.compile(optimizer=sgd,loss='binary_crossentropy',metrics=['mae','acc'])
+	return model
+
+
+def train(model,input,seed=None,batch_size=1000,depth=4):
+
+	train_indices,test_indices = bl.split_indices(input.shape[0],190000,2000,seed)
+	input_test = bl.take_rows(input,test_indices)
+
+	history = model.fit_generator(bl.batch_generator(input,train_indices,batch_size,depth=depth),
+		steps_per_epoch=bl.steps_per_epoch(train_indices,batch_size),epochs=20,
+		validation_data=(input_test,input_test))
+	return history,input_test
+
+
+def synthetic_batches(model,batch_size,seed=0):
+
+	# Sparse 0/1 rows of the real width, with targets shaped like the
+	# model's output.
+	random = np.random.RandomState(seed)
+	input_dim = model.input_shape[1]
+	output_shape = (batch_size,)+tuple(model.output_shape[1:])
+	while True:
+		batch = (random.rand(batch_size,input_dim) < 0.05).astype(np.float32)
+		if output_shape == batch.shape:
+			yield batch,batch
+		else:
+			yield batch,(random.rand(*output_shape) < 0.5).astype(np.float32)
+
+
+def real_batches(model,input,batch_size,depth):
+
+	output_shape = tuple(model.output_shape[1:])
+	indices = np.arange(input.shape[0])
+	for batch,target in bl.batch_generator(input,indices,batch_size,depth=depth):
+		if target.shape[1:] != output_shape:
+			target = np.zeros((len(batch),)+output_shape,dtype=np.float32)
+		yield batch,target
 
-sgd = optimizers.SGD(lr=0.1)
-input_img = Input(shape=(10000,))
-conv1 = Conv1D(5,10,strides=5,activation=None)(input_img)
-pooling1 = MaxPooling1D(pool_size=5)(conv1)
-conv2 = Conv1D(20,25,strides=20,activation=None)(pooling1)
-pooling2 = MaxPooling1D(pool_size=20)(conv2)
-dense1 = Dense(100,activation='sigmoid')(pooling2)
-dense2 = Dense(100,activation='sigmoid')(dense1)
-dense3 = Dense(1,activation='sigmoid')(dense2)
 
-autoencoder = Model(input_img,dense3)
+def peak_rss_mb():
 
-autoencoder.compile(optimizer=sgd,loss='binary_crossentropy',metrics=['mae','acc'])
+	# ru_maxrss is in kilobytes on Linux but in bytes on macOS.
+	maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	if sys.platform == 'darwin':
+		return maxrss/(1024.0*1024.0)
+	return maxrss/1024.0
 
-np.random.shuffle(input)
-input_train = input[:190000]
-input_test = input[190000:192000]
 
-history = autoencoder.fit(input_train,input_train,
-	epochs=20,batch_size=1000,shuffle=True,
-	validation_data=(input_test,input_test))
+def benchmark(model,batches,steps,warmup,batch_size):
 
+	for step in range(warmup):
+		x,y = next(batches)
+		model.train_on_batch(x,y)
+	latencies = np.zeros(steps)
+	start = time.time()
+	for step in range(steps):
+		tick = time.time()
+		x,y = next(batches)
+		model.train_on_batch(x,y)
+		latencies[step] = time.time()-tick
+	elapsed = time.time()-start
 
+	throughput = steps*batch_size/elapsed
+	return {'batch_size':batch_size,
+		'steps':steps,
+		'samples_per_sec':throughput,
+		'seconds_per_epoch':190000/throughput,
+		'latency_ms':{'p50':1000*np.percentile(latencies,50),
+			'p90':1000*np.percentile(latencies,90),
+			'p99':1000*np.percentile(latencies,99)},
+		'peak_rss_mb':peak_rss_mb()}
+
+
+def __main__():
+
+	args = parse_arguments()
+
+	if args.benchmark:
+		if args.benchmark == 'dense':
+			model = build_autoencoder()[0]
+		elif args.benchmark == 'conv':
+			model = build_conv_model()
+		else:
+			raise ValueError('--benchmark must be dense or conv')
+		if args.real:
+			batches = real_batches(model,read_in_data(args.input),args.batch_size,args.prefetch)
+		else:
+			batches = synthetic_batches(model,args.batch_size)
+		result = benchmark(model,batches,args.steps,args.warmup,args.batch_size)
+		result['model'] = args.benchmark
+		result['data'] = args.input if args.real else 'synthetic'
+		print json.dumps(result,sort_keys=True)
+		return
+
+	input = read_in_data(args.input)
+	print input.shape
+
+	autoencoder,encoder,decoder = build_autoencoder()
+	history,input_test = train(autoencoder,input,batch_size=args.batch_size,depth=args.prefetch)
+
+	encoded_imgs = encoder.predict(input_test)
+	decoded_imgs = decoder.predict(encoded_imgs)
+	print input_test[2].tolist()
+	print encoded_imgs[2].tolist()
+	print decoded_imgs[2].tolist()
+
+
+if __name__ == '__main__':
+	__main__()
@@ -0,0 +1,155 @@
+# Mini-batch loading for autoencoding.py.
+# The input matrix is memory-mapped rather than read into RAM, shuffling is
+# done on row indices, and batches are prefetched on a background thread.
+# Inputs can also be stored sparse (.npz, CSR) or bit-packed (.bits.npy);
+# only the rows of the current batch are ever expanded to dense.
+
+import argparse
+import threading
+import numpy as np
+from scipy import sparse
+
+try:
+	import Queue as queue
+except ImportError:
+	import queue
+
+
+def parse_arguments():
+
+	parser = argparse.ArgumentParser(description='convert a dense input .npy to a compact format')
+	parser.add_argument('-i','--input',type=str,help='the dense .npy input')
+	parser.add_argument('-o','--output',type=str,help='a .npz (CSR) or .bits.npy (bit-packed) output')
+	parser.add_argument('-c','--chunksize',type=int,default=10000,help='rows converted at a time')
+
+	return parser.parse_args()
+
+
+class PackedRows(object):
+
+	# Rows stored with np.packbits, one bit per column. Indexing unpacks
+	# only the requested rows.
+
+	def __init__(self,packed,width=None):
+		self.packed = packed
+		self.width = width or packed.shape[1]*8
+		self.shape = (packed.shape[0],self.width)
+
+	def __len__(self):
+		return self.shape[0]
+
+	def __getitem__(self,indices):
+		return np.unpackbits(self.packed[indices],axis=-1)[...,:self.width]
+
+
+def open_input(path,width=None):
+
+	# width is only needed for bit-packed inputs whose column count
+	# isn't a multiple of 8.
+	if path.endswith('.npz'):
+		return sparse.load_npz(path).tocsr()
+	if path.endswith('.bits.npy'):
+		return PackedRows(np.load(path,mmap_mode='r'),width)
+	return np.load(path,mmap_mode='r')
+
+
+def convert_to_csr(inpath,outpath,chunksize=10000):
+
+	data = open_input(inpath)
+	blocks = [sparse.csr_matrix(data[start:start+chunksize]) for start in range(0,len(data),chunksize)]
+	sparse.save_npz(outpath,sparse.vstack(blocks,format='csr'))
+
+
+def convert_to_bits(inpath,outpath,chunksize=10000):
+
+	# Any positive value becomes a 1, so this is only lossless for
+	# 0/1 indicator inputs.
+	data = open_input(inpath)
+	packed = np.lib.format.open_memmap(outpath,mode='w+',dtype=np.uint8,
+		shape=(data.shape[0],(data.shape[1]+7)//8))
+	for start in range(0,len(data),chunksize):
+		packed[start:start+chunksize] = np.packbits(data[start:start+chunksize] > 0,axis=1)
+	packed.flush()
+
+
+def split_indices(n_rows,n_train,n_test,seed=None):
+
+	# Equivalent to shuffling the rows and slicing [:n_train] and
+	# [n_train:n_train+n_test], without touching the data.
+	order = np.random.RandomState(seed).permutation(n_rows)
+	return order[:n_train],order[n_train:n_train+n_test]
+
+
+def take_rows(data,indices):
+
+	# Reading sorted rows keeps the reads on the mapping sequential.
+	rows = data[np.sort(indices)]
+	if sparse.issparse(rows):
+		rows = rows.toarray()
+	return np.asarray(rows,dtype=np.float32)
+
+
+def steps_per_epoch(indices,batch_size):
+
+	return (len(indices)+batch_size-1)//batch_size
+
+
+def iterate_batches(data,indices,batch_size,seed=None,epochs=None):
+
+	random = np.random.RandomState(seed)
+	epoch = 0
+	while epochs is None or epoch < epochs:
+		order = random.permutation(indices)
+		for start in range(0,len(order),batch_size):
+			batch = take_rows(data,order[start:start+batch_size])
+			yield batch,batch
+		epoch += 1
+
+
+def prefetch(batches,depth=4):
+
+	# Runs a batch iterator on a daemon thread, keeping up to depth batches
+	# ready so disk reads overlap with training.
+	ready = queue.Queue(maxsize=depth)
+	finished = object()
+
+	def produce():
+		try:
+			for batch in batches:
+				ready.put(batch)
+		except Exception as error:
+			ready.put(error)
+		ready.put(finished)
+
+	thread = threading.Thread(target=produce)
+	thread.daemon = True
+	thread.start()
+	while True:
+		batch = ready.get()
+		if batch is finished:
+			return
+		if isinstance(batch,Exception):
+			raise batch
+		yield batch
+
+
+def batch_generator(data,indices,batch_size,seed=None,epochs=None,depth=4):
+
+	# Endless (x, x) batches for Keras' fit_generator, in a fresh shuffled
+	# order every epoch.
+	return prefetch(iterate_batches(data,indices,batch_size,seed,epochs),depth)
+
+
+def __main__():
+
+	args = parse_arguments()
+	if args.output.endswith('.npz'):
+		convert_to_csr(args.input,args.output,args.chunksize)
+	elif args.output.endswith('.bits.npy'):
+		convert_to_bits(args.input,args.output,args.chunksize)
+	else:
+		raise ValueError('output must end in .npz or .bits.npy')
+
+
+if __name__ == '__main__':
+	__main__()
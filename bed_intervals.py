@@ -0,0 +1,163 @@
+import numpy as np
+import argparse
+import os
+
+# This module does the work of the six bedtools intersect calls that
+# pipeline-v2.sh used to run for every ChIP target. Each .bed file is
+# read once into NumPy start/end arrays per chromosome, and every event
+# is sorted into true/false positives/negatives with searchsorted, all
+# in memory. The four event files it writes are the same rows bedtools
+# produced, so ROC-validation.py can read them unchanged.
+
+def parse_arguments():
+    # There is one argument: -e, the experiment directory, which holds
+    # footprints.bed and the ChIP-validation folder.
+
+    parser = argparse.ArgumentParser(description='Sorts ChIP-validation events into TP/FP/FN/TN.')
+    parser.add_argument('-e','--experiment',type=str,help='the output directory')
+
+    return parser.parse_args()
+
+
+def read_bed(file):
+
+    # Here we read a .bed file into its raw lines, for
+    # writing back out, and its coordinates as arrays.
+    # Header lines (track, browser and # comments) are
+    # skipped, as bedtools skips them.
+    bedfile = open(file)
+    lines = [line.rstrip('\r\n') for line in bedfile
+             if line.strip() and not line.startswith(('track','browser','#'))]
+    bedfile.close()
+
+    fields = [line.split('\t',3) for line in lines]
+    chroms = np.array([field[0] for field in fields])
+    starts = np.array([int(field[1]) for field in fields],dtype=np.int64)
+    ends = np.array([int(field[2]) for field in fields],dtype=np.int64)
+
+    return lines,chroms,starts,ends
+
+
+def index_intervals(chroms,starts,ends):
+
+    # For every chromosome we keep the intervals sorted by
+    # start (with their original row numbers), the ends
+    # sorted on their own, and the longest interval, which
+    # bounds how far back an overlapping start can be.
+    index = {}
+    for chrom in np.unique(chroms):
+        rows = np.nonzero(chroms == chrom)[0]
+        order = rows[np.argsort(starts[rows],kind='mergesort')]
+        index[chrom] = (order,starts[order],ends[order],np.sort(ends[rows]),
+                        int((ends[rows]-starts[rows]).max()))
+
+    return index
+
+
+def overlap_counts(chroms,starts,ends,index):
+
+    # The number of indexed intervals overlapping each query
+    # interval is the number that start before it ends, less
+    # the number that end before it starts.
+    counts = np.zeros(len(chroms),dtype=np.int64)
+    for chrom in np.unique(chroms):
+        if chrom not in index:
+            continue
+        rows = np.nonzero(chroms == chrom)[0]
+        order,b_starts,b_ends,sorted_ends,longest = index[chrom]
+        counts[rows] = (np.searchsorted(b_starts,ends[rows],'left')
+                        -np.searchsorted(sorted_ends,starts[rows],'right'))
+
+    return counts
+
+
+def overlap_pairs(chroms,starts,ends,index):
+
+    # Every (query row, indexed row) pair that overlaps, like
+    # bedtools intersect -wa -wb. Candidates start after the
+    # query start minus the longest interval and before the
+    # query end; the ones that end too early are dropped.
+    a_rows = []; b_rows = []
+    for chrom in np.unique(chroms):
+        if chrom not in index:
+            continue
+        rows = np.nonzero(chroms == chrom)[0]
+        order,b_starts,b_ends,sorted_ends,longest = index[chrom]
+        lo = np.searchsorted(b_starts,starts[rows]-longest,'right')
+        hi = np.searchsorted(b_starts,ends[rows],'left')
+        counts = np.maximum(hi-lo,0)
+        a = np.repeat(rows,counts)
+        b = np.arange(counts.sum())-np.repeat(np.cumsum(counts)-counts,counts)+np.repeat(lo,counts)
+        keep = b_ends[b] > starts[a]
+        a_rows.append(a[keep]); b_rows.append(order[b[keep]])
+    if not a_rows:
+        return np.zeros(0,dtype=np.int64),np.zeros(0,dtype=np.int64)
+
+    a_rows = np.concatenate(a_rows); b_rows = np.concatenate(b_rows)
+    # Rows come back in event order, as bedtools reports them.
+    order = np.argsort(a_rows,kind='mergesort')
+
+    return a_rows[order],b_rows[order]
+
+
+def classify_events(events,footprints,chip):
+
+    # Here each of events, footprints and chip is the output
+    # of read_bed. Positives are (event, footprint) pairs and
+    # negatives are events with no footprint. A row is "true"
+    # or "false" by whether its event overlaps a ChIP peak;
+    # like bedtools -wa, a row is repeated once per peak.
+    e_lines,e_chroms,e_starts,e_ends = events
+    f_lines,f_chroms,f_starts,f_ends = footprints
+    c_lines,c_chroms,c_starts,c_ends = chip
+
+    footprint_index = index_intervals(f_chroms,f_starts,f_ends)
+    pos_events,pos_footprints = overlap_pairs(e_chroms,e_starts,e_ends,footprint_index)
+    neg_events = np.nonzero(overlap_counts(e_chroms,e_starts,e_ends,footprint_index) == 0)[0]
+    chip_counts = overlap_counts(e_chroms,e_starts,e_ends,
+                                 index_intervals(c_chroms,c_starts,c_ends))
+
+    pos_hits = chip_counts[pos_events]
+    neg_hits = chip_counts[neg_events]
+    return {'true_positives':(np.repeat(pos_events,pos_hits),np.repeat(pos_footprints,pos_hits)),
+            'false_positives':(pos_events[pos_hits == 0],pos_footprints[pos_hits == 0]),
+            'false_negatives':(np.repeat(neg_events,neg_hits),None),
+            'true_negatives':(neg_events[neg_hits == 0],None)}
+
+
+def write_classes(directory,classes,events,footprints):
+
+    # The four event files, one row per event (joined to its
+    # footprint for the positives).
+    e_lines = events[0]; f_lines = footprints[0]
+    for name in classes:
+        event_rows,footprint_rows = classes[name]
+        outfile = open(directory+'/'+name+'.bed','w')
+        if footprint_rows is None:
+            for i in event_rows:
+                outfile.write(e_lines[i]+'\n')
+        else:
+            for i,j in zip(event_rows,footprint_rows):
+                outfile.write(e_lines[i]+'\t'+f_lines[j]+'\n')
+        outfile.close()
+
+
+def classify_experiment(experiment):
+
+    # The footprints are read once for every ChIP target.
+    footprints = read_bed(experiment+'/footprints.bed')
+    for chip_target in sorted(os.listdir(experiment+'/ChIP-validation')):
+        directory = experiment+'/ChIP-validation/'+chip_target
+        events = read_bed(directory+'/segBarozzi.bed')
+        chip = read_bed(directory+'/sortedchip.bed')
+        write_classes(directory,classify_events(events,footprints,chip),events,footprints)
+
+
+def __main__():
+
+    args = parse_arguments()
+    classify_experiment(args.experiment)
+
+
+if __name__ == '__main__':
+    __main__()
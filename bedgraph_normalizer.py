@@ -4,14 +4,87 @@ csv.field_size_limit(sys.maxsize)
 
 import glob
 import argparse
+import json
+import os
 import numpy as np
+import pandas as pd
 
 parser = argparse.ArgumentParser()
 parser.add_argument('-f','--folder',type=str,help='the folder')
+parser.add_argument('-s','--stream',action='store_true',help='normalize the bedgraph in chunks instead of loading it whole')
+parser.add_argument('-c','--chunksize',type=int,default=1000000,help='rows per chunk with --stream')
+parser.add_argument('-i','--index',type=str,default='slurm_reads.json',help='the mapped-read-count index of slurm logs')
+parser.add_argument('-r','--reindex',action='store_true',help='rescan every slurm log')
 args = parser.parse_args()
 
 folder = args.folder
 
+def scan_slurm(slurm):
+	# The bowtie2 summary and the picard.bam line come early in a
+	# pipeline log, so the log is read in blocks only until both
+	# have been seen.
+	slurmfile = open(slurm)
+	blocks = []; tail = ''
+	found_reads = False; found_folder = False
+	block = slurmfile.read(1<<16)
+	while block:
+		blocks.append(block)
+		window = tail+block
+		found_reads = found_reads or window.find(' reads; of these:') != -1
+		found_folder = found_folder or window.find('/picard.bam as a bam file') != -1
+		if found_reads and found_folder:
+			break
+		tail = block[-64:]
+		block = slurmfile.read(1<<16)
+	slurmfile.close()
+	openfile = ''.join(blocks)
+	readsend = openfile.find(' reads; of these:')
+	folderend = openfile.find('/picard.bam as a bam file')
+	if readsend == -1:
+		return None,None
+	return openfile[:folderend].split('/')[-1],int(openfile[:readsend].split('\n')[-1])
+
+# Read counts are kept in an index keyed by slurm log name, and a log is
+# only scanned again if its size or mtime has changed.
+index = {}
+if os.path.exists(args.index) and not args.reindex:
+	index = json.load(open(args.index))
+
+slurms = glob.glob('slurm-*')
+
+mapped_reads = {}
+updated = False
+for slurm in slurms:
+	stat = os.stat(slurm)
+	entry = index.get(slurm)
+	if entry is None or entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime:
+		key,reads = scan_slurm(slurm)
+		entry = {'size':stat.st_size,'mtime':stat.st_mtime,'folder':key,'reads':reads}
+		index[slurm] = entry
+		updated = True
+	if entry['reads'] is not None:
+		mapped_reads[entry['folder']] = entry['reads']
+		print entry['folder'],entry['reads']
+
+if updated:
+	indexfile = open(args.index+'.tmp','w')
+	json.dump(index,indexfile)
+	indexfile.close()
+	os.rename(args.index+'.tmp',args.index)
+
+if args.stream:
+	# Chunks are read as typed columns, scaled to reads per million in
+	# one array operation and appended to the output, so memory stays
+	# flat however large the bedgraph is.
+	chunks = pd.read_csv(folder+'/peaks.bedgraph',sep='\t',header=None,usecols=[0,1,2,3],
+		dtype={0:'category',1:np.int64,2:np.int64,3:np.float64},chunksize=args.chunksize)
+	file = open('return/'+folder+'.bedgraph','w')
+	for chunk in chunks:
+		chunk[3] = 1000000*chunk[3]/mapped_reads[folder]
+		chunk.to_csv(file,sep='\t',header=False,index=False)
+	file.close()
+	sys.exit()
+
 file = open(folder+'/peaks.bedgraph')
 bedgraph = []
 for line in csv.reader(file,delimiter='\n'):
@@ -23,18 +96,6 @@ for line in bedgraph:
 	height = float(line[3])
 	peak_heights.append(height)
 
-slurms = glob.glob('slurm-*')
-
-mapped_reads = {}
-for slurm in slurms:
-	openfile = open(slurm).read()
-	readsend = openfile.find(' reads; of these:')
-	folderend = openfile.find('/picard.bam as a bam file')
-	if readsend != -1:
-		key = openfile[:folderend].split('/')[-1]
-		mapped_reads[key] = int(openfile[:readsend].split('\n')[-1])
-		print key,int(openfile[:readsend].split('\n')[-1])
-
 return_bedgraph = []
 for line in bedgraph:
 	line = line[:3] + [1000000*float(line[3])/mapped_reads[folder]]
@@ -42,4 +103,4 @@ for line in bedgraph:
 
 file = open('return/'+folder+'.bedgraph','w')
 for line in return_bedgraph:
-	file.write(line[0]+'\t'+line[1]+'\t'+line[2]+'\t'+str(line[3])+'\n')
\ No newline at end of file
+	file.write(line[0]+'\t'+line[1]+'\t'+line[2]+'\t'+str(line[3])+'\n')
@@ -3,6 +3,11 @@ import sys
 csv.field_size_limit(sys.maxsize)
 import argparse
 import pickle
+import gzip
+import mmap
+import os
+import collections
+import multiprocessing
 import numpy as np
 
 
@@ -11,6 +16,11 @@ def parse_args():
 	parser = argparse.ArgumentParser(description='make .npy files for deep learning')
 	parser.add_argument('-f','--fasta',type=str,help='the fasta file, with headers')
 	parser.add_argument('-o','--output',type=str,help='the measured output of the system, as a pickled dict')
+	parser.add_argument('-l','--length',type=int,help='pad or truncate every sequence to this length and write a dense uint8 tensor')
+	parser.add_argument('-b','--buckets',type=str,help='comma-separated bucket lengths; writes one padded shard per bucket')
+	parser.add_argument('-s','--shardsize',type=int,help='with --length, stream records into fixed-size .npy shards of this many rows')
+	parser.add_argument('-p','--processes',type=int,help='worker processes for sharded encoding (default: all cores)')
+	parser.add_argument('-i','--indexed',action='store_true',help='seek to the needed records through a .fai index instead of parsing the whole fasta')
 
 	return parser.parse_args()
 
@@ -31,6 +41,160 @@ def read_in_fasta(inpath):
 	return returndict
 
 
+def is_gzipped(inpath):
+
+	with open(inpath,'rb') as openfile:
+		return openfile.read(2) == b'\x1f\x8b'
+
+
+def open_fasta(inpath):
+
+	if is_gzipped(inpath):
+		return gzip.open(inpath,'rb')
+	return open(inpath,'rb')
+
+
+def fasta_key(header):
+
+	# Records are keyed by the first word of the header, as samtools
+	# faidx does, so streamed and indexed reads pair the same records
+	# with ydict.
+	words = header.split()
+	if not words:
+		return ''
+	return words[0].decode('ascii')
+
+
+def fasta_lines(openfile,blocksize):
+
+	# Lines are cut out of large binary blocks; a line that straddles
+	# blocks is held as a list of pieces and joined once.
+	partial = []
+	while True:
+		block = openfile.read(blocksize)
+		if not block:
+			break
+		lines = block.split(b'\n')
+		if len(lines) == 1:
+			partial.append(block)
+			continue
+		partial.append(lines[0])
+		lines[0] = b''.join(partial)
+		partial = [lines.pop()]
+		for line in lines:
+			yield line
+	last = b''.join(partial)
+	if last:
+		yield last
+
+
+def stream_fasta(inpath,blocksize=1<<22):
+
+	# Yields (key, sequence) with the key as text (see fasta_key) and the
+	# sequence left as bytes, which fast_DNA_1hE encodes without a copy.
+	fastaname = None; chunks = []
+	with open_fasta(inpath) as openfile:
+		for line in fasta_lines(openfile,blocksize):
+			line = line.rstrip(b'\r')
+			if line[:1] == b'>':
+				if fastaname is not None:
+					yield fastaname,b''.join(chunks)
+				fastaname = fasta_key(line[1:])
+				chunks = []
+			elif line:
+				chunks.append(line)
+	if fastaname is not None:
+		yield fastaname,b''.join(chunks)
+
+
+def build_fasta_index(inpath,indexpath=None):
+
+	# Writes a samtools-compatible .fai: name, length, offset of the first
+	# base, bases per line and bytes per line. Like samtools, every line of
+	# a record but the last must have the same width.
+	if is_gzipped(inpath):
+		raise ValueError(inpath+' is gzip-compressed and cannot be indexed')
+	if indexpath is None:
+		indexpath = inpath+'.fai'
+	entries = []; entry = None; short = False
+	offset = 0
+	with open(inpath,'rb') as openfile:
+		for line in openfile:
+			linelength = len(line)
+			if line[:1] == b'>':
+				if entry is not None:
+					entries.append(entry)
+				entry = [fasta_key(line[1:]),0,offset+linelength,0,0]
+				short = False
+			elif entry is not None:
+				bases = len(line.rstrip(b'\r\n'))
+				if bases:
+					if short or (entry[3] and (bases > entry[3] or linelength-bases != entry[4]-entry[3])):
+						raise ValueError('different line length in sequence '+entry[0])
+					if not entry[3]:
+						entry[3] = bases; entry[4] = linelength
+					short = bases < entry[3]
+					entry[1] += bases
+			offset += linelength
+	if entry is not None:
+		entries.append(entry)
+	with open(indexpath,'w') as indexfile:
+		for entry in entries:
+			indexfile.write('\t'.join([str(field) for field in entry])+'\n')
+	return indexpath
+
+
+def read_fasta_index(indexpath):
+
+	returndict = {}
+	with open(indexpath) as indexfile:
+		for line in indexfile:
+			tabs = line.rstrip('\n').split('\t')
+			returndict[tabs[0]] = tuple([int(field) for field in tabs[1:5]])
+	return returndict
+
+
+def mmap_fasta(inpath):
+
+	with open(inpath,'rb') as openfile:
+		return mmap.mmap(openfile.fileno(),0,access=mmap.ACCESS_READ)
+
+
+def fetch_sequence(mapped,entry,start=0,end=None):
+
+	# Pulls bases [start, end) of one record straight out of the mapping,
+	# touching only the lines that cover the range.
+	length,offset,linebases,linewidth = entry
+	if end is None or end > length:
+		end = length
+	if start >= end:
+		return b''
+	first = offset + (start//linebases)*linewidth + start%linebases
+	last = offset + ((end-1)//linebases)*linewidth + (end-1)%linebases + 1
+	raw = mapped[first:last]
+	if linewidth != linebases:
+		raw = raw.replace(b'\n',b'').replace(b'\r',b'')
+	return raw
+
+
+def indexed_fasta(inpath,keys):
+
+	# An index can only point into uncompressed bytes.
+	if is_gzipped(inpath):
+		raise ValueError(inpath+' is gzip-compressed; decompress it to use --indexed')
+	indexpath = inpath+'.fai'
+	if not os.path.exists(indexpath) or os.path.getmtime(indexpath) < os.path.getmtime(inpath):
+		build_fasta_index(inpath,indexpath)
+	index = read_fasta_index(indexpath)
+	mapped = mmap_fasta(inpath)
+	try:
+		for key in keys:
+			if key in index:
+				yield key,fetch_sequence(mapped,index[key])
+	finally:
+		mapped.close()
+
+
 def read_in_pickle(inpath):
 
 	with open(inpath,'rb') as openfile:
@@ -74,35 +238,247 @@ def DNA_1hE(sequence_DNA):
 	return _1hElol
 
 
+# A 256-entry lookup table from byte value to one-hot row. Lowercase bases
+# are folded in, and everything that isn't A/C/G/T stays all-zero, exactly
+# as in DNA_1hE.
+_1hE_TABLE = np.zeros((256,4),dtype=np.uint8)
+for _i,_letter in enumerate('ACGT'):
+	_1hE_TABLE[ord(_letter),_i] = 1
+	_1hE_TABLE[ord(_letter.lower()),_i] = 1
+
+
+def sequence_bytes(sequence_DNA):
+
+	if not isinstance(sequence_DNA,bytes):
+		sequence_DNA = sequence_DNA.encode('ascii','replace')
+	return np.frombuffer(sequence_DNA,dtype=np.uint8)
+
+
+def fast_DNA_1hE(sequence_DNA):
+
+	return _1hE_TABLE[sequence_bytes(sequence_DNA)]
+
+
+def batch_DNA_1hE(sequences,length=None,out=None):
+
+	if length is None:
+		length = max([len(sequence) for sequence in sequences] or [0])
+	if out is None:
+		out = np.zeros((len(sequences),length,4),dtype=np.uint8)
+	else:
+		length = out.shape[1]
+		out[:len(sequences)] = 0
+	for i,sequence in enumerate(sequences):
+		codes = sequence_bytes(sequence)[:length]
+		out[i,:len(codes)] = _1hE_TABLE[codes]
+	return out
+
+
+def matching_records(fasta,ydict):
+
+	# fasta is either a dict from read_in_fasta or a stream of
+	# (header, sequence) records from stream_fasta.
+	if isinstance(fasta,dict):
+		records = ((key,fasta[key]) for key in ydict if key in fasta)
+	else:
+		records = fasta
+	for key,sequence in records:
+		if key in ydict:
+			yield key,sequence
+
+
 def link_together(fasta,ydict):
 
 	x_list = []; y_list = []
-	for key in ydict:
-		if key in fasta:
-			sequence = fasta[key]
-			one_hot = DNA_1hE(sequence)
-			output = ydict[key]
-			x_list.append(output)
-			y_list.append(one_hot)
+	for key,sequence in matching_records(fasta,ydict):
+		one_hot = fast_DNA_1hE(sequence)
+		output = ydict[key]
+		x_list.append(output)
+		y_list.append(one_hot)
 	x_arr = np.array(x_list)
 	y_arr = np.array(y_list)
 	return x_arr,y_arr
 
 
+def pad_together(fasta,ydict,length):
+
+	# Same pairing as link_together, but the one-hot matrices land in one
+	# dense (N, length, 4) uint8 tensor that np.load can memory-map.
+	keys = []; x_list = []; sequences = []
+	for key,sequence in matching_records(fasta,ydict):
+		keys.append(key)
+		x_list.append(ydict[key])
+		sequences.append(sequence)
+	lengths = np.minimum(np.array([len(sequence) for sequence in sequences],dtype=np.int64),length)
+	y_arr = batch_DNA_1hE(sequences,length)
+	return keys,np.array(x_list),y_arr,lengths
+
+
+def bucket_together(fasta,ydict,buckets):
+
+	# Each record goes to the shortest bucket that holds it, and anything
+	# longer than the last bucket is truncated into it. The index of each
+	# bucket holds (record offset, length) for every row of the shard.
+	buckets = sorted(buckets)
+	keys = []; x_list = []
+	members = [[] for bucket in buckets]
+	for key,sequence in matching_records(fasta,ydict):
+		slot = min(np.searchsorted(buckets,len(sequence)),len(buckets)-1)
+		members[slot].append((len(keys),sequence))
+		keys.append(key)
+		x_list.append(ydict[key])
+	x_arr = np.array(x_list)
+	shards = []
+	for bucket,member in zip(buckets,members):
+		offsets = np.array([offset for offset,sequence in member],dtype=np.int64)
+		lengths = np.array([min(len(sequence),bucket) for offset,sequence in member],dtype=np.int64)
+		y_arr = batch_DNA_1hE([sequence for offset,sequence in member],bucket)
+		shards.append((bucket,x_arr[offsets],y_arr,np.column_stack([offsets,lengths])))
+	return keys,shards
+
+
+def encode_chunk(chunk):
+
+	keys,outputs,sequences,length = chunk
+	lengths = np.minimum(np.array([len(sequence) for sequence in sequences],dtype=np.int64),length)
+	return keys,np.array(outputs),batch_DNA_1hE(sequences,length),lengths
+
+
+def chunk_records(fasta,ydict,length,chunksize):
+
+	keys = []; outputs = []; sequences = []
+	for key,sequence in matching_records(fasta,ydict):
+		keys.append(key)
+		outputs.append(ydict[key])
+		sequences.append(sequence)
+		if len(keys) == chunksize:
+			yield keys,outputs,sequences,length
+			keys = []; outputs = []; sequences = []
+	if keys:
+		yield keys,outputs,sequences,length
+
+
+def open_shard(prefix,number,shardsize,length,x_array):
+
+	x_shard = np.lib.format.open_memmap(prefix+'.'+str(number)+'.x.npy',mode='w+',
+		dtype=x_array.dtype,shape=(shardsize,)+x_array.shape[1:])
+	y_shard = np.lib.format.open_memmap(prefix+'.'+str(number)+'.y.npy',mode='w+',
+		dtype=np.uint8,shape=(shardsize,length,4))
+	l_shard = np.lib.format.open_memmap(prefix+'.'+str(number)+'.lengths.npy',mode='w+',
+		dtype=np.int64,shape=(shardsize,))
+	return [x_shard,y_shard,l_shard]
+
+
+def close_shard(prefix,number,shard,rows):
+
+	# The last shard is usually short; its arrays are copied into files of
+	# the right size so no shard carries trailing empty rows.
+	for array,suffix in zip(shard,['x','y','lengths']):
+		path = prefix+'.'+str(number)+'.'+suffix+'.npy'
+		if rows < len(array):
+			trimmed = np.lib.format.open_memmap(path+'.tmp',mode='w+',dtype=array.dtype,shape=(rows,)+array.shape[1:])
+			trimmed[:] = array[:rows]
+			trimmed.flush()
+			del trimmed
+			os.rename(path+'.tmp',path)
+		else:
+			array.flush()
+
+
+def shard_together(fasta,ydict,length,shardsize,processes=None,chunksize=1000,prefix='shard'):
+
+	# Chunks of records are one-hot encoded in a process pool and copied
+	# into memory-mapped shards of shardsize rows. At most two chunks per
+	# worker are in flight, so memory doesn't grow with the fasta. The
+	# manifest lists each record's ID, shard number and row.
+	pool = multiprocessing.Pool(processes)
+	maxinflight = 2*(processes or multiprocessing.cpu_count())
+	inflight = collections.deque()
+	chunks = chunk_records(fasta,ydict,length,chunksize)
+	shard = None; number = 0; row = 0
+	manifest = open(prefix+'.manifest.txt','w')
+	try:
+		while True:
+			for chunk in chunks:
+				inflight.append(pool.apply_async(encode_chunk,(chunk,)))
+				if len(inflight) >= maxinflight:
+					break
+			if not inflight:
+				break
+			keys,x_array,y_array,lengths = inflight.popleft().get()
+			start = 0
+			while start < len(keys):
+				if shard is None:
+					shard = open_shard(prefix,number,shardsize,length,x_array)
+				stop = start+min(shardsize-row,len(keys)-start)
+				shard[0][row:row+stop-start] = x_array[start:stop]
+				shard[1][row:row+stop-start] = y_array[start:stop]
+				shard[2][row:row+stop-start] = lengths[start:stop]
+				for i in range(start,stop):
+					manifest.write(keys[i]+'\t'+str(number)+'\t'+str(row+i-start)+'\n')
+				row += stop-start
+				start = stop
+				if row == shardsize:
+					close_shard(prefix,number,shard,row)
+					shard = None; number += 1; row = 0
+		if shard is not None:
+			close_shard(prefix,number,shard,row)
+	finally:
+		pool.close()
+		pool.join()
+		manifest.close()
+
+
 def print_nparrays(x_array,y_array):
 
 	np.save('x.npy',x_array)
 	np.save('y.npy',y_array)
 
 
+def print_ids(keys,outpath):
+
+	with open(outpath,'w') as openfile:
+		for key in keys:
+			openfile.write(key+'\n')
+
+
+def print_padded(keys,x_array,y_array,lengths):
+
+	print_nparrays(x_array,y_array)
+	np.save('lengths.npy',lengths)
+	print_ids(keys,'ids.txt')
+
+
+def print_buckets(keys,shards):
+
+	for bucket,x_array,y_array,index in shards:
+		np.save('x.'+str(bucket)+'.npy',x_array)
+		np.save('y.'+str(bucket)+'.npy',y_array)
+		np.save('index.'+str(bucket)+'.npy',index)
+	print_ids(keys,'ids.txt')
+
+
 def __main__():
 	
 	args = parse_args()
 	fastapath = args.fasta; outputpath = args.output
-	fasta = read_in_fasta(fastapath)
 	ydict = read_in_pickle(outputpath)
-	x_arr,y_arr = link_together(fasta,ydict)
-	print_nparrays(x_arr,y_arr)
+	if args.indexed:
+		fasta = indexed_fasta(fastapath,ydict)
+	else:
+		fasta = stream_fasta(fastapath)
+	if args.buckets:
+		buckets = [int(bucket) for bucket in args.buckets.split(',')]
+		keys,shards = bucket_together(fasta,ydict,buckets)
+		print_buckets(keys,shards)
+	elif args.length and args.shardsize:
+		shard_together(fasta,ydict,args.length,args.shardsize,args.processes)
+	elif args.length:
+		keys,x_arr,y_arr,lengths = pad_together(fasta,ydict,args.length)
+		print_padded(keys,x_arr,y_arr,lengths)
+	else:
+		x_arr,y_arr = link_together(fasta,ydict)
+		print_nparrays(x_arr,y_arr)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,202 @@
+# A columnar on-disk copy of a footprint JSON file, for
+# networkmultiQuerular.py and tydon_package.py.
+#
+# A footprint file is a list of [region, footprints] records. A region is
+# [chrom, start, end, ...], a footprint is [[chrom, start, end], p-value,
+# q-value, score, PWM hits] (or [[chrom, start, end], PWM hit] in the
+# output-v2 files), and a PWM hit is [chrom, start, end, x, name, ...].
+# Each level becomes a set of typed .npy columns in one directory, with
+# offset arrays for the nesting: the footprints of region i are rows
+# region_offsets[i]:region_offsets[i+1] of the footprint columns, and the
+# hits of footprint j are rows footprint_offsets[j]:footprint_offsets[j+1]
+# of the hit columns. Chromosomes, PWM names and any leftover fields are
+# interned into string tables. Every column can be memory-mapped.
+#
+# tydon_package.py --convert keeps its promoter columns, which have the
+# ENSTs appended, apart from these, in a -enst.columns directory.
+
+import argparse
+import json
+import os
+from array import array
+import numpy as np
+import footprint_json as fj
+
+# Typecodes for array.array, which has no 'q' on Python 2; 'l' is a
+# 64-bit C long on Linux.
+COLUMNS = {'region_chrom':'i','region_start':'l','region_end':'l','region_extra':'i','region_offsets':'l',
+           'footprint_chrom':'i','footprint_start':'l','footprint_end':'l','footprint_p':'d',
+           'footprint_q':'d','footprint_score':'d','footprint_kind':'b','footprint_offsets':'l',
+           'hit_chrom':'i','hit_start':'l','hit_end':'l','hit_name':'i','hit_extra':'i'}
+TABLES = ['chroms','names','extras']
+
+
+def parse_arguments():
+
+    parser = argparse.ArgumentParser(description='convert a footprint JSON file to columns')
+    parser.add_argument('-i','--input',type=str,help='the footprint .json file')
+    parser.add_argument('-o','--output',type=str,help='the output directory (default: input with .columns)')
+
+    return parser.parse_args()
+
+
+def columns_path(filepath):
+
+    return filepath[:-len('.json')]+'.columns' if filepath.endswith('.json') else filepath+'.columns'
+
+
+def columns_current(path,filepath):
+
+    # A columns directory is only used if its string tables, which are
+    # written last, are no older than the JSON it was converted from.
+    tables = [os.path.join(path,table+'.json') for table in TABLES]
+    for table in tables:
+        if not os.path.exists(table):
+            return False
+    if not os.path.exists(filepath):
+        return True
+    return min([os.path.getmtime(table) for table in tables]) >= os.path.getmtime(filepath)
+
+
+def write_columns(records,outpath):
+
+    # records is any iterable of footprint records, so the JSON can be
+    # streamed straight in.
+    columns = {}
+    for column,code in COLUMNS.items():
+        columns[column] = array(code)
+    tables = {}
+    for table in TABLES:
+        tables[table] = {}
+    def intern(table,value):
+        if value not in tables[table]:
+            tables[table][value] = len(tables[table])
+        return tables[table][value]
+
+    columns['region_offsets'].append(0)
+    columns['footprint_offsets'].append(0)
+    for record in records:
+        region = record[0]
+        columns['region_chrom'].append(intern('chroms',region[0]))
+        columns['region_start'].append(int(region[1]))
+        columns['region_end'].append(int(region[2]))
+        columns['region_extra'].append(intern('extras',json.dumps(region[3:])))
+        for footprint in record[1]:
+            columns['footprint_chrom'].append(intern('chroms',footprint[0][0]))
+            columns['footprint_start'].append(int(footprint[0][1]))
+            columns['footprint_end'].append(int(footprint[0][2]))
+            if isinstance(footprint[1],list):
+                hits = [footprint[1]]
+                values = [np.nan,np.nan,np.nan]
+                columns['footprint_kind'].append(1)
+            else:
+                hits = footprint[4]
+                values = footprint[1:4]
+                columns['footprint_kind'].append(0)
+            columns['footprint_p'].append(float(values[0]))
+            columns['footprint_q'].append(float(values[1]))
+            columns['footprint_score'].append(float(values[2]))
+            for hit in hits:
+                columns['hit_chrom'].append(intern('chroms',hit[0]))
+                columns['hit_start'].append(int(hit[1]))
+                columns['hit_end'].append(int(hit[2]))
+                columns['hit_name'].append(intern('names',hit[4]))
+                columns['hit_extra'].append(intern('extras',json.dumps([hit[3]]+list(hit[5:]))))
+            columns['footprint_offsets'].append(len(columns['hit_chrom']))
+        columns['region_offsets'].append(len(columns['footprint_chrom']))
+
+    if not os.path.isdir(outpath):
+        os.makedirs(outpath)
+    for column,values in columns.items():
+        np.save(os.path.join(outpath,column+'.npy'),np.frombuffer(values,dtype=values.typecode))
+    for table in TABLES:
+        strings = [None]*len(tables[table])
+        for value,i in tables[table].items():
+            strings[i] = value
+        with open(os.path.join(outpath,table+'.json'),'w') as file:
+            json.dump(strings,file)
+
+
+def convert(filepath,outpath=None):
+
+    if outpath is None:
+        outpath = columns_path(filepath)
+    write_columns((record for index,record in fj.iter_footprints(filepath)),outpath)
+    return outpath
+
+
+def open_columns(path):
+
+    columns = {}
+    for column in COLUMNS:
+        columns[column] = np.load(os.path.join(path,column+'.npy'),mmap_mode='r')
+    for table in TABLES:
+        with open(os.path.join(path,table+'.json')) as file:
+            columns[table] = json.load(file)
+    return columns
+
+
+def column_record(columns,i):
+
+    # Rebuilds record i in the same nested-list shape as the JSON.
+    chroms = columns['chroms']; names = columns['names']; extras = columns['extras']
+    region = [chroms[columns['region_chrom'][i]],int(columns['region_start'][i]),int(columns['region_end'][i])]
+    region += json.loads(extras[columns['region_extra'][i]])
+    footprints = []
+    for j in range(columns['region_offsets'][i],columns['region_offsets'][i+1]):
+        coordinates = [chroms[columns['footprint_chrom'][j]],int(columns['footprint_start'][j]),int(columns['footprint_end'][j])]
+        hits = []
+        for k in range(columns['footprint_offsets'][j],columns['footprint_offsets'][j+1]):
+            extra = json.loads(extras[columns['hit_extra'][k]])
+            hits.append([chroms[columns['hit_chrom'][k]],int(columns['hit_start'][k]),int(columns['hit_end'][k]),
+                         extra[0],names[columns['hit_name'][k]]]+extra[1:])
+        if columns['footprint_kind'][j] == 1:
+            footprints.append([coordinates,hits[0]])
+        else:
+            footprints.append([coordinates,float(columns['footprint_p'][j]),float(columns['footprint_q'][j]),
+                               float(columns['footprint_score'][j]),hits])
+    return [region,footprints]
+
+
+class ColumnRecords(object):
+
+    # List-like view over a columns directory; records are rebuilt on
+    # access, so changes to them aren't kept.
+
+    def __init__(self,path):
+        self.columns = open_columns(path)
+
+    def __len__(self):
+        return len(self.columns['region_chrom'])
+
+    def __getitem__(self,i):
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError(i)
+        return column_record(self.columns,i)
+
+
+def column_regulators(path):
+
+    # The same per-record regulator lists as
+    # footprint_json.footprint_regulators, read from the hit name column.
+    columns = open_columns(path)
+    names = columns['names']
+    hit_bounds = np.asarray(columns['footprint_offsets'])[np.asarray(columns['region_offsets'])]
+    hit_name = columns['hit_name']
+    regulators = []
+    for i in range(len(hit_bounds)-1):
+        ids = np.unique(hit_name[hit_bounds[i]:hit_bounds[i+1]])
+        regulators.append(sorted([names[j] for j in ids]))
+    return regulators
+
+
+def __main__():
+
+    args = parse_arguments()
+    convert(args.input,args.output)
+
+
+if __name__ == '__main__':
+    __main__()
@@ -0,0 +1,94 @@
+# Incremental reading of the -promoter_footprints.json,
+# -enhancer_footprints.json and -meta_associations.json files shared by
+# networkmultiQuerular.py and tydon_package.py.
+#
+# The footprint files are JSON arrays of [region, footprints] records and
+# the association file is an object of gene -> [promoter indices,
+# enhancer indices].
+#
+# Streaming needs ijson (pip install ijson): records are then parsed one
+# at a time instead of json.load reading the whole text and every object
+# into memory at once. Without ijson these functions still work, but
+# fall back to json.load and stream nothing.
+
+import json
+import re
+from decimal import Decimal
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# use_float only exists from ijson 3.1. It is never passed to older
+# versions, whose C backend can crash on an unknown keyword.
+if ijson is None:
+    USE_FLOAT = False
+else:
+    USE_FLOAT = tuple(map(int,re.match(r'(\d+)\.(\d+)',ijson.__version__).groups())) >= (3,1)
+
+
+def plain_numbers(value):
+
+    # ijson before 3.1 has no use_float and yields Decimals, which
+    # json.dumps can't serialize, so they are turned back into floats.
+    if isinstance(value,Decimal):
+        return float(value)
+    if isinstance(value,list):
+        return [plain_numbers(item) for item in value]
+    if isinstance(value,tuple):
+        return tuple([plain_numbers(item) for item in value])
+    if isinstance(value,dict):
+        return dict([(key,plain_numbers(item)) for key,item in value.items()])
+    return value
+
+
+def ijson_records(parse,file,prefix):
+
+    if USE_FLOAT:
+        return parse(file,prefix,use_float=True)
+    return (plain_numbers(record) for record in parse(file,prefix))
+
+
+def iter_footprints(filepath):
+
+    # Yields (index, record) for each record of a footprint file.
+    with open(filepath,'rb') as file:
+        if ijson is None:
+            records = json.load(file)
+        else:
+            records = ijson_records(ijson.items,file,'item')
+        for index,record in enumerate(records):
+            yield index,record
+
+
+def iter_associations(filepath):
+
+    # Yields (gene, [promoter indices, enhancer indices]).
+    with open(filepath,'rb') as file:
+        if ijson is None:
+            items = json.load(file).items()
+        else:
+            items = ijson_records(ijson.kvitems,file,'')
+        for gene,indices in items:
+            yield gene,indices
+
+
+def load_footprints(filepath):
+
+    return [record for index,record in iter_footprints(filepath)]
+
+
+def load_associations(filepath):
+
+    return dict(iter_associations(filepath))
+
+
+def footprint_regulators(filepath):
+
+    # For each record, the sorted distinct genes whose PWMs hit its
+    # footprints (footprint[1][4]); none of the coordinates are kept.
+    regulators = []
+    for index,record in iter_footprints(filepath):
+        regulators.append(sorted(set([footprint[1][4] for footprint in record[1]])))
+    return regulators
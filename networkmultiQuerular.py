@@ -1,8 +1,22 @@
 import argparse
 import json
+import os
+import threading
+import collections
+import multiprocessing
+import numpy as np
 import networkx as nx
+import footprint_json as fj
+import footprint_columns as fc
 
-G = nx.DiGraph()
+try:
+    from urllib.parse import urlparse,parse_qs
+    from http.server import HTTPServer,BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from urlparse import urlparse,parse_qs
+    from BaseHTTPServer import HTTPServer,BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
 
 def parse_arguments():
 
@@ -11,13 +25,31 @@ def parse_arguments():
     parser.add_argument('-g','--genelist',type=str)
     parser.add_argument('-d','--depth',type=int)
     parser.add_argument('-n','--name',type=str)
+    parser.add_argument('-s','--serve',type=int,help='load the comma-separated --project list once and answer queries over HTTP on this port')
+    parser.add_argument('-c','--cache-size',type=int,default=256,help='subgraph results kept by the server')
+    parser.add_argument('-B','--batch',type=str,help='a file of project<TAB>genelist lines; writes one GraphML per project')
+    parser.add_argument('-P','--processes',type=int,help='worker processes for --batch (default: all cores)')
+    parser.add_argument('-m','--merge',action='store_true',help='with --batch, also write a merged graph whose edges list their projects')
+    parser.add_argument('-b','--build-index',action='store_true',help='compile the project JSONs into an adjacency index and exit')
 
     return parser.parse_args()
 
-def load_json(filepath):
+def footprint_regulators(filepath):
 
-    with open(filepath) as file:
-        return json.load(file)
+    # Prefers a footprint_columns copy of the file when one is current.
+    if fc.columns_current(fc.columns_path(filepath),filepath):
+        return fc.column_regulators(fc.columns_path(filepath))
+    return fj.footprint_regulators(filepath)
+
+def load_regulator_lists(prefix):
+
+    # Streams the three project JSONs, keeping only the association
+    # indices and each footprint record's regulator genes.
+    index_dict = fj.load_associations(prefix+'-meta_associations.json')
+    promoter_regulators = footprint_regulators(prefix+'-promoter_footprints.json')
+    enhancer_regulators = footprint_regulators(prefix+'-enhancer_footprints.json')
+
+    return index_dict,promoter_regulators,enhancer_regulators
 
 def read_ensg_name(genome):
 
@@ -31,57 +63,287 @@ def read_ensg_name(genome):
 
     return outputdict
 
-def recursive_pwm_search(dict,plist,elist,gene,depth,ensg_name):
-    
-    if depth == 0:
-        return None
-    depth = depth - 1
-    
+def regulators_from_lists(dict,p_regulators,e_regulators,gene):
+
     new_genes = []
     if gene in dict:
-        p_indices = dict[gene][0]
-        e_indices = dict[gene][1]
-        for index in p_indices:
-            for footprint in plist[index][1]:
-                new_genes.append(footprint[1][4])
-        for index in e_indices:
-            for footprint in elist[index][1]:
-                new_genes.append(footprint[1][4])
-    
-    new_genes = list(set(new_genes))
+        for index in dict[gene][0]:
+            new_genes += p_regulators[index]
+        for index in dict[gene][1]:
+            new_genes += e_regulators[index]
+
+    return new_genes
+
+def build_adjacency(dict,p_regulators,e_regulators,prefix):
+
+    # Compiles the gene -> regulator relation into CSR arrays of integer
+    # gene IDs: the regulators of gene i are indices[indptr[i]:indptr[i+1]].
+    # Written as prefix-genes.txt, prefix-indptr.npy and prefix-indices.npy.
+    gene_ids = {}
+    names = []
+    def gene_id(gene):
+        if gene not in gene_ids:
+            gene_ids[gene] = len(names)
+            names.append(gene)
+        return gene_ids[gene]
+
+    for gene in dict:
+        gene_id(gene)
+    rows = []
+    for gene in list(names):
+        regulators = set(regulators_from_lists(dict,p_regulators,e_regulators,gene))
+        rows.append(sorted([gene_id(regulator) for regulator in regulators]))
+    rows += [[] for i in range(len(names)-len(rows))]
+
+    indptr = np.zeros(len(rows)+1,dtype=np.int64)
+    indptr[1:] = np.cumsum([len(row) for row in rows])
+    indices = np.zeros(indptr[-1],dtype=np.int32)
+    for i,row in enumerate(rows):
+        indices[indptr[i]:indptr[i+1]] = row
+
+    with open(prefix+'-genes.txt','w') as file:
+        for name in names:
+            file.write(name+'\n')
+    np.save(prefix+'-indptr.npy',indptr)
+    np.save(prefix+'-indices.npy',indices)
+
+def load_adjacency(prefix):
+
+    with open(prefix+'-genes.txt') as file:
+        names = file.read().split('\n')[:-1]
+    gene_ids = {}
+    for i,name in enumerate(names):
+        gene_ids[name] = i
+    indptr = np.load(prefix+'-indptr.npy',mmap_mode='r')
+    indices = np.load(prefix+'-indices.npy',mmap_mode='r')
+
+    return gene_ids,names,indptr,indices
+
+def regulators_from_adjacency(adjacency,gene):
+
+    gene_ids,names,indptr,indices = adjacency
+    if gene not in gene_ids:
+        return []
+    i = gene_ids[gene]
+
+    return [names[j] for j in indices[indptr[i]:indptr[i+1]]]
+
+def proper_name(gene,ensg_name):
 
     if gene in ensg_name:
-        gene_proper_name = ensg_name[gene]
+        return ensg_name[gene]
+    return gene
+
+def pwm_search(regulators,genes,depth,ensg_name,graph):
+
+    # Level-synchronous BFS over regulators(gene). A gene is expanded once,
+    # at the shallowest level it is reached, and only while that level is
+    # below depth. This gives the same edges as expanding every path to
+    # depth, in O(V+E).
+    expanded = {}
+    frontier = list(set(genes))
+    level = 0
+    while frontier and level < depth:
+        next_frontier = []
+        for gene in frontier:
+            if gene in expanded:
+                continue
+            expanded[gene] = level
+            gene_proper_name = proper_name(gene,ensg_name)
+            for new_gene in set(regulators(gene)):
+                graph.add_edge(proper_name(new_gene,ensg_name),gene_proper_name)
+                if new_gene not in expanded:
+                    next_frontier.append(new_gene)
+        frontier = next_frontier
+        level += 1
+
+    return expanded
+
+def project_prefix(project):
+
+    return '/data/ChioriniCompCor/metamachine/output-v2/'+project
+
+def adjacency_current(prefix):
+
+    # The adjacency index is only used if it was built after the
+    # project's three JSONs were last written.
+    index = [prefix+'-adjacency'+suffix for suffix in ['-genes.txt','-indptr.npy','-indices.npy']]
+    for path in index:
+        if not os.path.exists(path):
+            return False
+    sources = [prefix+suffix for suffix in ['-meta_associations.json','-promoter_footprints.json','-enhancer_footprints.json']]
+    sources = [path for path in sources if os.path.exists(path)]
+    if not sources:
+        return True
+    return min([os.path.getmtime(path) for path in index]) >= max([os.path.getmtime(path) for path in sources])
+
+def load_project(project):
+
+    # Returns a regulators(gene) function for the project, from its
+    # adjacency index if one is current, and the genome's name table.
+    prefix = project_prefix(project)
+    genome = project.split('_')[0]
+    ensg_name = read_ensg_name(genome)
+
+    if adjacency_current(prefix):
+        adjacency = load_adjacency(prefix+'-adjacency')
+        regulators = lambda gene: regulators_from_adjacency(adjacency,gene)
     else:
-        gene_proper_name = gene
+        index_dict,p_regulators,e_regulators = load_regulator_lists(prefix)
+        regulators = lambda gene: regulators_from_lists(index_dict,p_regulators,e_regulators,gene)
+
+    return regulators,ensg_name
+
+def graph_to_text(graph,format):
+
+    if format == 'graphml':
+        return '\n'.join(nx.generate_graphml(graph))
+    return json.dumps({'edges':sorted(graph.edges())})
+
+class QueryServer(ThreadingMixIn,HTTPServer):
+
+    # Keeps every project's graph warm and answers
+    # GET /query?project=P&genes=A,B&depth=D[&format=graphml]
+    # with a JSON edge list or GraphML. Recent answers are kept in an LRU.
+    daemon_threads = True
 
-    for new_gene in new_genes:
-        recursive_pwm_search(dict,plist,elist,new_gene,depth,ensg_name)
-        if new_gene in ensg_name:
-            new_gene_proper_name = ensg_name[new_gene]
+    def __init__(self,address,projects,cache_size):
+        HTTPServer.__init__(self,address,QueryHandler)
+        self.projects = projects
+        self.cache_size = cache_size
+        self.cache = collections.OrderedDict()
+        self.cache_lock = threading.Lock()
+
+    def answer(self,project,genes,depth,format):
+        key = (project,tuple(sorted(set(genes))),depth,format)
+        with self.cache_lock:
+            if key in self.cache:
+                text = self.cache.pop(key)
+                self.cache[key] = text
+                return text
+        regulators,ensg_name = self.projects[project]
+        graph = nx.DiGraph()
+        pwm_search(regulators,genes,depth,ensg_name,graph)
+        text = graph_to_text(graph,format)
+        with self.cache_lock:
+            self.cache[key] = text
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return text
+
+class QueryHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        try:
+            if url.path != '/query':
+                raise KeyError(url.path)
+            project = query['project'][0]
+            genes = query['genes'][0].split(',')
+            depth = int(query['depth'][0])
+            format = query.get('format',['json'])[0]
+            if format not in ('json','graphml'):
+                raise ValueError('format must be json or graphml')
+            if project not in self.server.projects:
+                raise KeyError(project)
+        except (KeyError,ValueError) as error:
+            self.reply(400,'text/plain','bad query: '+str(error))
+            return
+        text = self.server.answer(project,genes,depth,format)
+        if format == 'graphml':
+            self.reply(200,'application/xml',text)
         else:
-            new_gene_proper_name = new_gene
-        G.add_edge(new_gene_proper_name,gene_proper_name)
+            self.reply(200,'application/json',text)
+
+    def reply(self,status,content_type,text):
+        body = text.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type',content_type)
+        self.send_header('Content-Length',str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def serve(projects,port,cache_size):
+
+    loaded = {}
+    for project in projects:
+        loaded[project] = load_project(project)
+    server = QueryServer(('127.0.0.1',port),loaded,cache_size)
+    server.serve_forever()
+
+def read_batch(path):
 
+    tasks = []
+    with open(path) as file:
+        for line in file:
+            tabs = line.rstrip('\n').split('\t')
+            if len(tabs) >= 2:
+                tasks.append((tabs[0],tabs[1].split(',')))
+
+    return tasks
+
+def extract_project(task):
+
+    # Runs in a worker process, so each project gets its own graph.
+    project,genes,depth,name = task
+    regulators,ensg_name = load_project(project)
+    graph = nx.DiGraph()
+    pwm_search(regulators,genes,depth,ensg_name,graph)
+    nx.write_graphml(graph,name+'-'+project+'.graphml')
+
+    return project,list(graph.edges())
+
+def batch_extract(tasks,depth,name,processes=None,merge=False):
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = pool.map(extract_project,[(project,genes,depth,name) for project,genes in tasks])
+    finally:
+        pool.close()
+        pool.join()
+
+    if merge:
+        merged = nx.DiGraph()
+        for project,edges in results:
+            for source,target in edges:
+                if merged.has_edge(source,target):
+                    merged[source][target]['projects'].append(project)
+                else:
+                    merged.add_edge(source,target,projects=[project])
+        # GraphML attributes can't be lists.
+        for source,target,data in merged.edges(data=True):
+            data['projects'] = ','.join(sorted(set(data['projects'])))
+        nx.write_graphml(merged,name+'.graphml')
 
 def __main__():
 
     args = parse_arguments()
     project = args.project
+
+    if args.serve:
+        serve(project.split(','),args.serve,args.cache_size)
+        return
+
+    if args.batch:
+        batch_extract(read_batch(args.batch),args.depth,args.name,args.processes,args.merge)
+        return
+
+    if args.build_index:
+        prefix = project_prefix(project)
+        index_dict,p_regulators,e_regulators = load_regulator_lists(prefix)
+        build_adjacency(index_dict,p_regulators,e_regulators,prefix+'-adjacency')
+        return
+
     genes = args.genelist.split(',')
     depth = args.depth
     name = args.name
-    
-    genome = project.split('_')[0]
-    ensg_name = read_ensg_name(genome)
 
-    enhancer_fp = load_json('/data/ChioriniCompCor/metamachine/output-v2/'+project+'-enhancer_footprints.json')
-    promoter_fp = load_json('/data/ChioriniCompCor/metamachine/output-v2/'+project+'-promoter_footprints.json')
-    index_dict = load_json('/data/ChioriniCompCor/metamachine/output-v2/'+project+'-meta_associations.json')
-    for gene in genes:
-        recursive_pwm_search(index_dict,promoter_fp,enhancer_fp,gene,depth,ensg_name)
+    regulators,ensg_name = load_project(project)
+    graph = nx.DiGraph()
+    pwm_search(regulators,genes,depth,ensg_name,graph)
 
-    nx.write_graphml(G,name+'.graphml')
+    nx.write_graphml(graph,name+'.graphml')
 
 if __name__ == '__main__':
     __main__()
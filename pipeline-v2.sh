@@ -122,14 +122,9 @@ rm $EXPERIMENT/picard.bam.bai
 if [[ -d $DATA/ChIP-validation ]]
     then cp -R $DATA/ChIP-validation $EXPERIMENT/ChIP-validation
     cp $EXPERIMENT/footprints/*.bed $EXPERIMENT/footprints.bed
-    for chip in $EXPERIMENT/ChIP-validation/*
-        do bedtools intersect -a $chip/segBarozzi.bed -b $EXPERIMENT/footprints.bed -wa -wb > $chip/positives.bed
-        bedtools intersect -a $chip/segBarozzi.bed -b $EXPERIMENT/footprints.bed -v > $chip/negatives.bed
-        bedtools intersect -a $chip/positives.bed -b $chip/sortedchip.bed -wa > $chip/true_positives.bed
-        bedtools intersect -a $chip/positives.bed -b $chip/sortedchip.bed -v > $chip/false_positives.bed
-        bedtools intersect -a $chip/negatives.bed -b $chip/sortedchip.bed -wa > $chip/false_negatives.bed
-        bedtools intersect -a $chip/negatives.bed -b $chip/sortedchip.bed -v > $chip/true_negatives.bed
-    done
+    # One pass per ChIP target sorts the events into TP/FP/FN/TN in memory,
+    # in place of six bedtools intersect calls each.
+    python /data/pranzatellitj/tools/bed_intervals.py -e $EXPERIMENT
     python /data/pranzatellitj/tools/ROC.py -e $EXPERIMENT -f -5
     echo "AUC of the ROC plot produced."
     rm -R $EXPERIMENT/ChIP-validation
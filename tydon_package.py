@@ -10,10 +10,13 @@ import sys
 csv.field_size_limit(sys.maxsize)
 
 import json
+import footprint_json as fj
+import footprint_columns as fc
 import enst_identifier as ei
 import copy
 import argparse
 import os
+import multiprocessing
 
 
 def get_size(obj, seen=None):
@@ -42,15 +45,14 @@ def parse_arguments():
     parser = argparse.ArgumentParser()
     parser.add_argument('-p','--project',type=str)
     parser.add_argument('-g','--memory',type=int)
+    parser.add_argument('-b','--byte-shards',action='store_true',help='cut shards by their serialized size instead of estimated in-memory size')
+    parser.add_argument('-n','--ndjson',action='store_true',help='build entries in worker processes and stream them into newline-delimited shards with a manifest')
+    parser.add_argument('-j','--processes',type=int,help='worker processes for --ndjson (default: all cores)')
+    parser.add_argument('-c','--convert',action='store_true',help='write columnar copies of the footprint files and exit')
     
     return parser.parse_args()
 
 
-def load_json(filepath):
-    
-    with open(filepath) as file:
-        return json.load(file)
-
 def package_as_json(object,number,path,encsr):
 
     with open(path+'/'+encsr+'-subdictionary'+str(number)+'.json','w') as infile:
@@ -58,39 +60,79 @@ def package_as_json(object,number,path,encsr):
         json.dump(object,infile)
 
 
+def new_memo():
+
+    # Promoters and enhancers are shared by many genes, so each one is
+    # flattened once per run and reused; coordinate keys are built once per
+    # distinct coordinate. A fresh memo is made for every run, since its
+    # entries are keyed by index into that run's footprint lists.
+    return {'promoters':{},'enhancers':{},'coordinates':{}}
+
+
+def coordinate_key(chrom,start,end,memo):
+
+    coordinate_keys = memo['coordinates']
+    key = (chrom,start,end)
+    if key not in coordinate_keys:
+        coordinate_keys[key] = chrom+':'+str(start)+'-'+str(end)
+    return coordinate_keys[key]
+
+
+def flatten_footprints(footprints,memo):
+
+    fp_dict = {}
+    for footprint in footprints:
+        PWM_dict = {'p-value':footprint[1],'q-value':footprint[2],'score':footprint[3]}
+        fp_key = coordinate_key(footprint[0][0],footprint[0][1],footprint[0][2],memo)
+        for PWM in footprint[4]:
+            PWM_key = PWM[4]+'@'+coordinate_key(PWM[0],PWM[1],PWM[2],memo)
+            PWM_dict[PWM_key] = PWM
+        fp_dict[fp_key] = PWM_dict
+
+    return fp_dict
+
+
+def flatten_promoter(pfp,ENST,memo):
+
+    flattened_promoters = memo['promoters']
+    if ENST not in flattened_promoters:
+        promoter = pfp[ENST]
+        ENST_key = promoter[0][-1] + '@' + coordinate_key(promoter[0][0],promoter[0][1],promoter[0][2],memo)
+        flattened_promoters[ENST] = (ENST_key,flatten_footprints(promoter[1],memo))
+    return flattened_promoters[ENST]
+
+
+def flatten_enhancer(efp,enhancer_i,memo):
+
+    flattened_enhancers = memo['enhancers']
+    if enhancer_i not in flattened_enhancers:
+        enhancer = efp[enhancer_i]
+        enhancer_key = coordinate_key(enhancer[0][0],enhancer[0][1],enhancer[0][2],memo)
+        flattened_enhancers[enhancer_i] = (enhancer_key,flatten_footprints(enhancer[1],memo))
+    return flattened_enhancers[enhancer_i]
+
+
+def build_entry(ENST_index,enhancer_index,pfp,efp,memo):
+
+    newdict = {}
+    for ENST in ENST_index:
+        ENST_key,fp_dict = flatten_promoter(pfp,ENST,memo)
+        newdict[ENST_key] = fp_dict
+    for enhancer_i in enhancer_index:
+        enhancer_key,fp_dict = flatten_enhancer(efp,enhancer_i,memo)
+        newdict[enhancer_key] = fp_dict
+
+    return newdict
+
+
 def dict_to_json(dma,pfp,efp,mem,project,encsr):
 
     size_before = 0
     count = 0
     dict = {}
-    for ENSG in dma:
-        ENST_index = dma[ENSG][0]
-        enhancer_index = dma[ENSG][1]
-        newdict = {}
-        for ENST in ENST_index:
-            promoter = pfp[ENST]
-            ENST_key = promoter[0][-1] + '@' + promoter[0][0]+':'+str(promoter[0][1])+'-'+str(promoter[0][2])
-            fp_dict = {}
-            for footprint in promoter[1]:
-                PWM_dict = {'p-value':footprint[1],'q-value':footprint[2],'score':footprint[3]}
-                fp_key = footprint[0][0]+':'+str(footprint[0][1])+'-'+str(footprint[0][2])
-                for PWM in footprint[4]:
-                    PWM_key = PWM[4]+'@'+PWM[0]+':'+str(PWM[1])+'-'+str(PWM[2])
-                    PWM_dict[PWM_key] = PWM
-                fp_dict[fp_key] = PWM_dict
-            newdict[ENST_key] = fp_dict
-        for enhancer_i in enhancer_index:
-            enhancer = efp[enhancer_i]
-            enhancer_key = enhancer[0][0]+':'+str(enhancer[0][1])+'-'+str(enhancer[0][2])
-            fp_dict = {}
-            for footprint in enhancer[1]:
-                PWM_dict = {'p-value':footprint[1],'q-value':footprint[2],'score':footprint[3]}
-                fp_key = footprint[0][0]+':'+str(footprint[0][1])+'-'+str(footprint[0][2])
-                for PWM in footprint[4]:
-                    PWM_key = PWM[4]+'@'+PWM[0]+':'+str(PWM[1])+'-'+str(PWM[2])
-                    PWM_dict[PWM_key] = PWM
-                fp_dict[fp_key] = PWM_dict
-            newdict[enhancer_key] = fp_dict
+    memo = new_memo()
+    for ENSG,indices in dma:
+        newdict = build_entry(indices[0],indices[1],pfp,efp,memo)
         size_after = get_size(newdict)
         if size_after + size_before >= mem:
             package_as_json(dict,count,project,encsr)
@@ -102,19 +144,121 @@ def dict_to_json(dma,pfp,efp,mem,project,encsr):
     package_as_json(dict,count,project,encsr)
 
 
+def package_encoded(entries,number,path,encsr):
+
+    # entries are already-serialized '"ENSG": {...}' members, so the file
+    # is the same JSON object json.dump would have written.
+    with open(path+'/'+encsr+'-subdictionary'+str(number)+'.json','w') as infile:
+        infile.write('{'+', '.join(entries)+'}')
+
+
+def dict_to_json_bytes(dma,pfp,efp,mem,project,encsr):
+
+    # Like dict_to_json, but each gene is serialized once as it is built
+    # and shards are cut when the bytes to be written would reach mem.
+    size_before = 2
+    count = 0
+    entries = []
+    memo = new_memo()
+    for ENSG,indices in dma:
+        entry = json.dumps(ENSG)+': '+json.dumps(build_entry(indices[0],indices[1],pfp,efp,memo))
+        size_after = len(entry)+2
+        if entries and size_after + size_before >= mem:
+            package_encoded(entries,count,project,encsr)
+            entries = []
+            size_before = 2
+            count += 1
+        size_before = size_before+size_after
+        entries.append(entry)
+    package_encoded(entries,count,project,encsr)
+
+
+# Footprint lists and a fresh memo for encode_entry. They are set before
+# the pool forks, so workers share the lists instead of receiving a
+# pickled copy, and each worker fills its own copy of the memo.
+worker_footprints = []
+
+
+def encode_entry(item):
+
+    ENSG,indices = item
+    pfp,efp,memo = worker_footprints
+    return ENSG,'{'+json.dumps(ENSG)+': '+json.dumps(build_entry(indices[0],indices[1],pfp,efp,memo))+'}\n'
+
+
+def dict_to_ndjson(dma,pfp,efp,mem,project,encsr,processes=None):
+
+    # Entries are built and serialized in worker processes and appended,
+    # one {"ENSG": {...}} object per line, to shards cut at mem bytes. The
+    # manifest lists each ENSG's shard, byte offset and length, so a reader
+    # can seek straight to one gene.
+    worker_footprints[:] = [pfp,efp,new_memo()]
+    pool = multiprocessing.Pool(processes)
+    count = 0
+    offset = 0
+    shard = open(project+'/'+encsr+'-subdictionary'+str(count)+'.ndjson','w')
+    manifest = open(project+'/'+encsr+'-manifest.tsv','w')
+    try:
+        for ENSG,line in pool.imap(encode_entry,dma,64):
+            if offset and offset + len(line) > mem:
+                shard.close()
+                count += 1
+                offset = 0
+                shard = open(project+'/'+encsr+'-subdictionary'+str(count)+'.ndjson','w')
+            shard.write(line)
+            manifest.write(ENSG+'\t'+str(count)+'\t'+str(offset)+'\t'+str(len(line))+'\n')
+            offset += len(line)
+    finally:
+        pool.close()
+        pool.join()
+        shard.close()
+        manifest.close()
+        worker_footprints[:] = []
+
+
+def enst_columns_path(p_path):
+
+    # The promoter columns written here have the ENSTs appended, so they
+    # get their own name, apart from the plain copy footprint_columns.py
+    # writes for networkmultiQuerular.
+    return p_path[:-len('.json')]+'-enst.columns'
+
+
 def __main__():
     
     args = parse_arguments()
     project = args.project
-    memory = args.memory * 750000000
     encsr = project.split('/')[-1]
     
-    e_fp = load_json(project+'/'+encsr+'-enhancer_footprints.json')
-    p_fp = load_json(project+'/'+encsr+'-promoter_footprints.json')
-    ei.append_enst(p_fp)
-    d_ma = load_json(project+'/'+encsr+'-meta_associations.json')
+    e_path = project+'/'+encsr+'-enhancer_footprints.json'
+    p_path = project+'/'+encsr+'-promoter_footprints.json'
+
+    if args.convert:
+        # The promoter columns are written after append_enst, so they can
+        # be read back directly.
+        fc.convert(e_path)
+        p_fp = fj.load_footprints(p_path)
+        ei.append_enst(p_fp)
+        fc.write_columns(p_fp,enst_columns_path(p_path))
+        return
+
+    if fc.columns_current(fc.columns_path(e_path),e_path) and fc.columns_current(enst_columns_path(p_path),p_path):
+        e_fp = fc.ColumnRecords(fc.columns_path(e_path))
+        p_fp = fc.ColumnRecords(enst_columns_path(p_path))
+    else:
+        e_fp = fj.load_footprints(e_path)
+        p_fp = fj.load_footprints(p_path)
+        ei.append_enst(p_fp)
+    memory = args.memory * 750000000
+    # The associations are only walked once, so they are streamed.
+    d_ma = fj.iter_associations(project+'/'+encsr+'-meta_associations.json')
 
-    dict_to_json(d_ma,p_fp,e_fp,memory,project,encsr)
+    if args.ndjson:
+        dict_to_ndjson(d_ma,p_fp,e_fp,memory,project,encsr,args.processes)
+    elif args.byte_shards:
+        dict_to_json_bytes(d_ma,p_fp,e_fp,memory,project,encsr)
+    else:
+        dict_to_json(d_ma,p_fp,e_fp,memory,project,encsr)
 
 
 